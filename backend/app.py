@@ -1,8 +1,10 @@
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 import uvicorn
 from pydantic import BaseModel
 from typing import List, Dict, Any, Optional
+import json
 import os
 
 from services.llm_service import LLMService
@@ -50,10 +52,10 @@ async def get_recommendations(request: RecommendationRequest):
     try:
         # Extract user preferences and browsing history from request
         user_preferences = request.preferences.dict()
-        browsing_history = request.browsing_history
+        browsing_history = frozenset(request.browsing_history)
         
         # Use the LLM service to generate recommendations
-        recommendations = llm_service.generate_recommendations(
+        recommendations = await llm_service.agenerate_recommendations(
             user_preferences,
             browsing_history,
             product_service.get_all_products()
@@ -64,6 +66,25 @@ async def get_recommendations(request: RecommendationRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/recommendations/stream")
+async def stream_recommendations(request: RecommendationRequest):
+    """
+    Stream personalized recommendations as newline-delimited JSON,
+    one recommendation per line as soon as the LLM produces it
+    """
+    user_preferences = request.preferences.dict()
+    browsing_history = frozenset(request.browsing_history)
+
+    async def recommendation_lines():
+        async for rec in llm_service.astream_recommendations(
+            user_preferences,
+            browsing_history,
+            product_service.get_all_products()
+        ):
+            yield json.dumps(rec) + "\n"
+
+    return StreamingResponse(recommendation_lines(), media_type="application/x-ndjson")
+
 # Custom exception handler for more user-friendly error messages
 @app.exception_handler(Exception)
 async def generic_exception_handler(request: Request, exc: Exception):
@@ -10,5 +10,16 @@ config = {
     'MODEL_NAME': os.getenv('MODEL_NAME', 'gpt-3.5-turbo'),
     'MAX_TOKENS': int(os.getenv('MAX_TOKENS', 1000)),
     'TEMPERATURE': float(os.getenv('TEMPERATURE', 0.7)),
-    'DATA_PATH': os.getenv('DATA_PATH', 'data/products.json')
+    'DATA_PATH': os.getenv('DATA_PATH', 'data/products.json'),
+    'EMBEDDING_MODEL': os.getenv('EMBEDDING_MODEL', 'text-embedding-3-small'),
+    'SEMANTIC_CACHE_THRESHOLD': float(os.getenv('SEMANTIC_CACHE_THRESHOLD', 0.9)),
+    'SEMANTIC_CACHE_MIN_MATCHES': int(os.getenv('SEMANTIC_CACHE_MIN_MATCHES', 3)),
+    'SEMANTIC_CACHE_MAX_ENTRIES': int(os.getenv('SEMANTIC_CACHE_MAX_ENTRIES', 10000)),
+    'PROMPT_CACHE_CONTROL': os.getenv('PROMPT_CACHE_CONTROL', 'false').lower() == 'true',
+    'MAX_CONCURRENT_REQUESTS': int(os.getenv('MAX_CONCURRENT_REQUESTS', 8)),
+    'TOKENS_PER_MINUTE': int(os.getenv('TOKENS_PER_MINUTE', 0)),
+    'LOCAL_ROUTING_THRESHOLD': int(os.getenv('LOCAL_ROUTING_THRESHOLD', 5)),
+    'CACHE_DIR': os.getenv('CACHE_DIR', '.rec_cache'),
+    'CACHE_TTL': int(os.getenv('CACHE_TTL', 7 * 24 * 60 * 60)),
+    'CATALOG_TOKEN_BUDGET': int(os.getenv('CATALOG_TOKEN_BUDGET', 800))
 }
\ No newline at end of file
@@ -1,15 +1,172 @@
 # services/llm_service.py
 
 import openai
+import asyncio
 import json
+import hashlib
 from config import config
 import random
+import requests
+import time
+from collections import deque
+from diskcache import Cache
+import numpy as np
+import tiktoken
+
+# Disk-backed cache of parsed LLM recommendations, shared across restarts.
+# Exact entries are keyed on a hash of the normalized request inputs, model
+# settings and catalog version; semantic entries live under SEMANTIC_KEY_PREFIX.
+# Every entry is tagged with its catalog version for invalidation.
+_llm_cache = Cache(config.get('CACHE_DIR', '.rec_cache'), tag_index=True)
+CATALOG_VERSION_KEY = "catalog_version"
+SEMANTIC_KEY_PREFIX = "semantic:"
+
+# Shared decoder for extracting the JSON array from LLM responses in place
+_json_decoder = json.JSONDecoder()
+
+class _SemanticIndex:
+    """
+    Bounded in-memory store of unit embeddings and their recommendations, each with
+    an expiry time. The embedding matrix grows by doubling; once full, the oldest rows
+    are overwritten
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.clear()
+
+    def clear(self):
+        """
+        Drop all rows
+        """
+        self._vectors = None
+        self._expires_at = None
+        self._recommendations = []
+        self._size = 0
+        self._next = 0
+
+    def add(self, embedding, recommendations, expires_at):
+        """
+        Add an embedding row and its recommendations, valid until the expires_at timestamp
+        """
+        # A non-positive max_entries disables the index
+        if self.max_entries <= 0:
+            return
+
+        if self._vectors is None:
+            self._vectors = np.empty((min(16, self.max_entries), len(embedding)), dtype=np.float32)
+            self._expires_at = np.empty(len(self._vectors), dtype=np.float64)
+        elif len(embedding) != self._vectors.shape[1]:
+            return
+
+        if self._size < self.max_entries:
+            if self._size == len(self._vectors):
+                grown = np.empty((min(2 * self._size, self.max_entries), self._vectors.shape[1]), dtype=np.float32)
+                grown[:self._size] = self._vectors
+                self._vectors = grown
+                grown_expiry = np.empty(len(grown), dtype=np.float64)
+                grown_expiry[:self._size] = self._expires_at
+                self._expires_at = grown_expiry
+            slot = self._size
+            self._size += 1
+            self._recommendations.append(None)
+        else:
+            slot = self._next
+            self._next = (self._next + 1) % self.max_entries
+
+        self._vectors[slot] = embedding
+        self._expires_at[slot] = expires_at
+        self._recommendations[slot] = list(recommendations)
+
+    def search(self, embedding, threshold):
+        """
+        Yield unexpired cached recommendation lists above the similarity threshold, most similar first
+        """
+        if not self._size or len(embedding) != self._vectors.shape[1]:
+            return
+
+        similarities = np.dot(self._vectors[:self._size], embedding)
+        # Expired rows can never match
+        similarities[self._expires_at[:self._size] <= time.time()] = -np.inf
+        for i in np.argsort(-similarities):
+            if similarities[i] <= threshold:
+                break
+            yield self._recommendations[i]
+
+# In-memory view of the semantic cache: row-normalized embeddings of the user
+# context block and the recommendations generated for each row
+_semantic_index = _SemanticIndex(config.get('SEMANTIC_CACHE_MAX_ENTRIES', 10000))
+
+class _JSONObjectStreamParser:
+    """
+    Incrementally extract complete JSON objects from a streamed JSON array
+    """
+
+    def __init__(self):
+        self._buffer = []
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, text):
+        """
+        Consume a chunk of text and return the objects whose braces closed within it
+        """
+        objects = []
+        for char in text:
+            if self._depth:
+                self._buffer.append(char)
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"' and self._depth:
+                self._in_string = True
+            elif char == '{':
+                if not self._depth:
+                    self._buffer = ['{']
+                self._depth += 1
+            elif char == '}' and self._depth:
+                self._depth -= 1
+                if not self._depth:
+                    try:
+                        objects.append(json.loads(''.join(self._buffer)))
+                    except ValueError:
+                        pass
+                    self._buffer = []
+
+        return objects
 
 class LLMService:
     """
     Service to handle interactions with the LLM API with fallback to local simulation
     """
 
+    # Price range options indexed for fallback lookups
+    PRICE_RANGES = ("0-50", "50-100", "100+")
+
+    # Bump when response parsing or the cached recommendation shape changes
+    RESPONSE_SCHEMA_VERSION = 1
+
+    # Static instructions sent as the system message, kept byte-identical across
+    # calls. At ~130 tokens this is below OpenAI's 1024-token minimum for prompt
+    # caching, so no provider-side caching discount is expected; keeping it
+    # stable only lets caching apply if the prefix later grows past the minimum.
+    SYSTEM_PREFIX = (
+        "You are an expert eCommerce recommendation assistant.\n"
+        "Given the user's preferences and browsing history, recommend **exactly 5 products** from the catalog.\n"
+        "Strictly follow these rules:\n"
+        "- Only recommend products matching the user's selected categories, brands, and price range.\n"
+        "- Include a brief explanation for each recommendation.\n"
+        "- Return output as a JSON array with keys: product_id (the catalog id), explanation, score (1-10 confidence).\n"
+        "- Ensure diversity in recommendations.\n"
+        "- Respond ONLY with the JSON array, no extra text."
+    )
+
     def __init__(self, use_openai=True):
         self.use_openai = use_openai
         
@@ -25,10 +182,61 @@ class LLMService:
             self.max_tokens = 500
             self.temperature = 0.7
 
+        # Add an explicit cache breakpoint to the system prefix; only honored by
+        # Anthropic-compatible routers and never sent to the OpenAI API itself
+        self.prompt_cache_control = config.get('PROMPT_CACHE_CONTROL', False)
+
+        # Token budget for the catalog block of the prompt
+        self.catalog_token_budget = config.get('CATALOG_TOKEN_BUDGET', 800)
+        # Load the tokenizer at startup; tiktoken may download it without a timeout
+        self._encoding = self._load_encoding()
+        self._token_counts = {}
+        self._catalog_blocks = {}
+
+        # Cache entry lifetime in seconds
+        self.cache_ttl = config.get('CACHE_TTL', 7 * 24 * 60 * 60)
+
+        # Cached results are only reused by a deploy with the same prompt settings
+        self._prompt_version = hashlib.sha256(json.dumps([
+            self.SYSTEM_PREFIX,
+            self.catalog_token_budget,
+            self.max_tokens,
+            self.RESPONSE_SCHEMA_VERSION
+        ]).encode()).hexdigest()
+
+        # Semantic cache configuration
+        self.embedding_model = config.get('EMBEDDING_MODEL', 'text-embedding-3-small')
+        self.semantic_threshold = config.get('SEMANTIC_CACHE_THRESHOLD', 0.9)
+        self.semantic_min_matches = config.get('SEMANTIC_CACHE_MIN_MATCHES', 3)
+
+        # Skip the LLM when the preferences match this many products or fewer
+        self.local_routing_threshold = config.get('LOCAL_ROUTING_THRESHOLD', 5)
+
+        # Async request throttling and single-flight state
+        self.max_concurrent_requests = config.get('MAX_CONCURRENT_REQUESTS', 8)
+        self.tokens_per_minute = config.get('TOKENS_PER_MINUTE', 0)
+        self._request_semaphore = None
+        self._token_window = deque()
+        self._inflight = {}
+
+        # Catalog the caches are currently valid for
+        self._catalog_ref = None
+        self._catalog_version = None
+        self._by_id = {}
+        self._categories = np.array([], dtype=str)
+        self._brands = np.array([], dtype=str)
+        self._prices = np.array([], dtype=float)
+        self._by_category = {}
+        self._by_brand = {}
+        self._by_price_range = {}
+
     def generate_recommendations(self, user_preferences, browsing_history, all_products):
         """
         Generate personalized product recommendations using OpenAI or local simulation
         """
+        self._sync_catalog(all_products)
+        browsing_history = frozenset(browsing_history or ())
+
         try:
             if self.use_openai:
                 return self._generate_openai_recommendations(user_preferences, browsing_history, all_products)
@@ -43,35 +251,441 @@ class LLMService:
             else:
                 return {
                     "recommendations": [],
+                    "input_tokens_used": 0,
+                    "error": str(e)
+                }
+
+    async def agenerate_recommendations(self, user_preferences, browsing_history, all_products):
+        """
+        Async variant of generate_recommendations that does not block the event loop on OpenAI calls
+        """
+        self._sync_catalog(all_products)
+        browsing_history = frozenset(browsing_history or ())
+
+        try:
+            if self.use_openai:
+                return await self._agenerate_openai_recommendations(user_preferences, browsing_history, all_products)
+            else:
+                return self._generate_local_recommendations(user_preferences, browsing_history, all_products)
+        except Exception as e:
+            print(f"Error in primary recommendation method: {str(e)}")
+            # Fallback to local recommendations if OpenAI fails
+            if self.use_openai:
+                print("Falling back to local recommendations...")
+                return self._generate_local_recommendations(user_preferences, browsing_history, all_products)
+            else:
+                return {
+                    "recommendations": [],
+                    "input_tokens_used": 0,
                     "error": str(e)
                 }
 
+    async def astream_recommendations(self, user_preferences, browsing_history, all_products):
+        """
+        Yield recommendations one at a time as soon as each becomes available
+        """
+        self._sync_catalog(all_products)
+        browsing_history = frozenset(browsing_history or ())
+
+        if not self.use_openai:
+            for rec in self._generate_local_recommendations(user_preferences, browsing_history, all_products)["recommendations"]:
+                yield dict(rec, input_tokens_used=0)
+            return
+
+        # Nothing for the LLM to rank when only a handful of products match. The routed
+        # result is final, so it is not topped up with fallback products
+        routed = self._route_locally(user_preferences, browsing_history, all_products)
+        if routed is not None:
+            for rec in routed["recommendations"]:
+                yield dict(rec, routed_locally=True, input_tokens_used=0)
+            return
+
+        # Every line carries the prompt tokens this request sent to the LLM
+        recommendations = []
+        input_tokens = 0
+        try:
+            async for rec, input_tokens in self._astream_openai_recommendations(user_preferences, browsing_history, all_products):
+                recommendations.append(rec)
+                yield dict(rec, input_tokens_used=input_tokens)
+        except Exception as e:
+            print(f"Error in primary recommendation method: {str(e)}")
+            # Fallback to local recommendations if OpenAI fails before producing anything
+            if not recommendations:
+                print("Falling back to local recommendations...")
+                for rec in self._generate_local_recommendations(user_preferences, browsing_history, all_products)["recommendations"]:
+                    yield dict(rec, input_tokens_used=0)
+                return
+
+        # Fallback: if less than 5, fill with random products matching preferences
+        if len(recommendations) < 5:
+            for rec in self._get_fallback_recommendations(user_preferences, recommendations, all_products):
+                yield dict(rec, input_tokens_used=input_tokens)
+
+    def generate_batch(self, users, all_products, poll_interval=30, timeout=24 * 60 * 60):
+        """
+        Precompute recommendations for many users through the OpenAI Batch API.
+        Each user is a dict with user_id, preferences and browsing_history;
+        returns a dict mapping user_id to the same payload as generate_recommendations
+        """
+        self._sync_catalog(all_products)
+
+        results = {}
+        pending = {}
+        request_lines = []
+        seen_user_ids = set()
+
+        for user in users:
+            user_id = str(user['user_id'])
+            if user_id in seen_user_ids:
+                # The Batch API rejects the whole file on a repeated custom_id
+                print(f"Skipping duplicate batch user_id: {user_id}")
+                continue
+            seen_user_ids.add(user_id)
+
+            user_preferences = user.get('preferences', {})
+            browsing_history = frozenset(user.get('browsing_history') or ())
+
+            if not self.use_openai:
+                results[user_id] = self._generate_local_recommendations(user_preferences, browsing_history, all_products)
+                continue
+
+            routed = self._route_locally(user_preferences, browsing_history, all_products)
+            if routed is not None:
+                results[user_id] = routed
+                continue
+
+            cache_key = self._get_cache_key(user_preferences, browsing_history)
+            cached = _llm_cache.get(cache_key)
+            if cached is not None:
+                results[user_id] = self._complete_recommendations(user_preferences, list(cached), all_products)
+                continue
+
+            if cache_key in pending:
+                # Users with identical requests share one batch line
+                pending[cache_key][2].append(user_id)
+                continue
+
+            browsed_products = self._get_browsed_products(browsing_history)
+            prompt = self._create_recommendation_prompt(user_preferences, browsed_products, all_products)
+            pending[cache_key] = (user_preferences, browsing_history, [user_id])
+            request_lines.append(json.dumps({
+                "custom_id": user_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": self.model_name,
+                    "messages": self._build_messages(prompt),
+                    "max_tokens": self.max_tokens,
+                    "temperature": self.temperature
+                }
+            }))
+
+        if not pending:
+            return results
+
+        try:
+            outputs = self._run_batch("\n".join(request_lines), poll_interval, timeout)
+        except Exception as e:
+            print(f"Error in batch recommendation job: {str(e)}")
+            outputs = {}
+
+        for cache_key, (user_preferences, browsing_history, user_ids) in pending.items():
+            # Each batch line is keyed by the first user that requested it
+            output = outputs.get(user_ids[0])
+            if output is None:
+                # Fallback to local recommendations for users the batch did not answer
+                for user_id in user_ids:
+                    results[user_id] = self._generate_local_recommendations(user_preferences, browsing_history, all_products)
+                continue
+
+            llm_output, input_tokens = output
+            recommendations = self._parse_recommendation_response(llm_output, all_products)
+            self._store_cached_recommendations(cache_key, None, recommendations)
+            for user_id in user_ids:
+                results[user_id] = self._complete_recommendations(user_preferences, list(recommendations), all_products, input_tokens)
+
+        return results
+
+    def _run_batch(self, requests_jsonl, poll_interval, timeout):
+        """
+        Upload a JSONL of chat requests, wait for the batch to finish and
+        return a dict mapping custom_id to the completion text and its prompt tokens
+        """
+        input_file = self._batch_api_request(
+            "post", "/files",
+            data={"purpose": "batch"},
+            files={"file": ("recommendations.jsonl", requests_jsonl.encode())}
+        ).json()
+
+        batch = self._batch_api_request("post", "/batches", json={
+            "input_file_id": input_file["id"],
+            "endpoint": "/v1/chat/completions",
+            "completion_window": "24h"
+        }).json()
+
+        deadline = time.monotonic() + timeout
+        while batch["status"] not in ("completed", "failed", "expired", "cancelled"):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Batch {batch['id']} did not finish within {timeout} seconds")
+            time.sleep(poll_interval)
+            batch = self._batch_api_request("get", f"/batches/{batch['id']}").json()
+
+        if not batch.get("output_file_id"):
+            raise RuntimeError(f"Batch {batch['id']} ended with status {batch['status']}")
+
+        output = self._batch_api_request("get", f"/files/{batch['output_file_id']}/content").text
+
+        outputs = {}
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            try:
+                result = json.loads(line)
+                response = result.get("response") or {}
+                if response.get("status_code") == 200:
+                    body = response["body"]
+                    outputs[result["custom_id"]] = (
+                        body["choices"][0]["message"]["content"],
+                        (body.get("usage") or {}).get("prompt_tokens", 0)
+                    )
+            except Exception as e:
+                # Keep the rest of the batch; the affected user falls back to local
+                print(f"Error parsing batch output line: {str(e)}")
+
+        return outputs
+
+    def _batch_api_request(self, method, path, **kwargs):
+        """
+        Call an OpenAI files/batches endpoint, which the pinned openai client does not wrap
+        """
+        response = requests.request(
+            method,
+            f"{openai.api_base}{path}",
+            headers={"Authorization": f"Bearer {openai.api_key}"},
+            timeout=60,
+            **kwargs
+        )
+        response.raise_for_status()
+        return response
+
     def _generate_openai_recommendations(self, user_preferences, browsing_history, all_products):
         """
         Generate recommendations using OpenAI API
         """
+        # Nothing for the LLM to rank when only a handful of products match
+        routed = self._route_locally(user_preferences, browsing_history, all_products)
+        if routed is not None:
+            return routed
+
+        cache_key = self._get_cache_key(user_preferences, browsing_history)
+        cached = _llm_cache.get(cache_key)
+        input_tokens = 0
+
+        if cached is None:
+            # Get browsed products details
+            browsed_products = self._get_browsed_products(browsing_history)
+
+            # Reuse recommendations from a near-identical preference set
+            embedding = self._get_embedding(self._format_user_context(user_preferences, browsed_products))
+            cached = self._lookup_semantic_cache(cache_key, embedding, user_preferences, browsing_history)
+
+        if cached is not None:
+            recommendations = list(cached)
+        else:
+            # Create LLM prompt
+            prompt = self._create_recommendation_prompt(user_preferences, browsed_products, all_products)
+            messages = self._build_messages(prompt)
+
+            # Call LLM API
+            response = openai.ChatCompletion.create(
+                model=self.model_name,
+                messages=messages,
+                max_tokens=self.max_tokens,
+                temperature=self.temperature
+            )
+
+            llm_output = response.choices[0].message.content
+            input_tokens = self._get_prompt_tokens(response, messages)
+
+            # Parse recommendations
+            recommendations = self._parse_recommendation_response(llm_output, all_products)
+            self._store_cached_recommendations(cache_key, embedding, recommendations)
+
+        return self._complete_recommendations(user_preferences, recommendations, all_products, input_tokens)
+
+    async def _agenerate_openai_recommendations(self, user_preferences, browsing_history, all_products):
+        """
+        Generate recommendations using the async OpenAI API, sharing one call between identical in-flight requests
+        """
+        # Nothing for the LLM to rank when only a handful of products match
+        routed = self._route_locally(user_preferences, browsing_history, all_products)
+        if routed is not None:
+            return routed
+
+        cache_key = self._get_cache_key(user_preferences, browsing_history)
+        cached = _llm_cache.get(cache_key)
+        input_tokens = 0
+
+        if cached is not None:
+            recommendations = list(cached)
+        elif cache_key in self._inflight:
+            # Identical request already running, wait for its result instead of calling the API again
+            recommendations = list(await asyncio.shield(self._inflight[cache_key]))
+        else:
+            future = self._start_inflight(cache_key)
+            result = error = None
+            try:
+                result, input_tokens = await self._afetch_recommendations(
+                    cache_key, user_preferences, browsing_history, all_products
+                )
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                self._finish_inflight(cache_key, future, result, error)
+            recommendations = list(result)
+
+        return self._complete_recommendations(user_preferences, recommendations, all_products, input_tokens)
+
+    async def _afetch_recommendations(self, cache_key, user_preferences, browsing_history, all_products):
+        """
+        Resolve an exact-cache miss through the semantic cache or a throttled async OpenAI call,
+        returning the recommendations and the input tokens sent
+        """
         # Get browsed products details
-        browsed_products = [p for p in all_products if p['id'] in browsing_history]
+        browsed_products = self._get_browsed_products(browsing_history)
+
+        # Reuse recommendations from a near-identical preference set
+        embedding = await self._aget_embedding(self._format_user_context(user_preferences, browsed_products))
+        cached = self._lookup_semantic_cache(cache_key, embedding, user_preferences, browsing_history)
+        if cached is not None:
+            return cached, 0
 
         # Create LLM prompt
         prompt = self._create_recommendation_prompt(user_preferences, browsed_products, all_products)
+        messages = self._build_messages(prompt)
 
-        # Call LLM API
-        response = openai.ChatCompletion.create(
-            model=self.model_name,
-            messages=[
-                {"role": "system", "content": "You are a helpful eCommerce product recommendation assistant."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=self.max_tokens,
-            temperature=self.temperature
-        )
+        # Call LLM API within the concurrency and tokens-per-minute limits,
+        # throttling on the local token estimate
+        await self._await_token_budget(self._count_message_tokens(messages) + self.max_tokens)
+        async with self._get_request_semaphore():
+            response = await openai.ChatCompletion.acreate(
+                model=self.model_name,
+                messages=messages,
+                max_tokens=self.max_tokens,
+                temperature=self.temperature
+            )
 
         llm_output = response.choices[0].message.content
+        input_tokens = self._get_prompt_tokens(response, messages)
 
         # Parse recommendations
         recommendations = self._parse_recommendation_response(llm_output, all_products)
+        self._store_cached_recommendations(cache_key, embedding, recommendations)
+
+        return recommendations, input_tokens
+
+    async def _astream_openai_recommendations(self, user_preferences, browsing_history, all_products):
+        """
+        Yield up to 5 LLM recommendations from the caches, an identical in-flight request
+        or a streamed OpenAI completion, each paired with the prompt tokens sent for it
+        """
+        cache_key = self._get_cache_key(user_preferences, browsing_history)
+        cached = _llm_cache.get(cache_key)
+
+        if cached is None and cache_key in self._inflight:
+            # Identical request already running, wait for its result instead of calling the API again
+            cached = await asyncio.shield(self._inflight[cache_key])
+
+        if cached is not None:
+            for rec in cached[:5]:
+                yield rec, 0
+            return
+
+        future = self._start_inflight(cache_key)
+        stream = self._astream_uncached_recommendations(cache_key, user_preferences, browsing_history, all_products)
+        recommendations = []
+        error = None
+        try:
+            async for rec, input_tokens in stream:
+                recommendations.append(rec)
+                yield rec, input_tokens
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            # Waiters get whatever was streamed, even if this consumer stopped early
+            self._finish_inflight(cache_key, future, None if error else recommendations, error)
+            await stream.aclose()
+
+    async def _astream_uncached_recommendations(self, cache_key, user_preferences, browsing_history, all_products):
+        """
+        Resolve an exact-cache miss through the semantic cache or a streamed OpenAI completion
+        """
+        # Get browsed products details
+        browsed_products = self._get_browsed_products(browsing_history)
+
+        # Reuse recommendations from a near-identical preference set
+        embedding = await self._aget_embedding(self._format_user_context(user_preferences, browsed_products))
+        cached = self._lookup_semantic_cache(cache_key, embedding, user_preferences, browsing_history)
+        if cached is not None:
+            for rec in cached[:5]:
+                yield rec, 0
+            return
+
+        # Create LLM prompt
+        prompt = self._create_recommendation_prompt(user_preferences, browsed_products, all_products)
+        messages = self._build_messages(prompt)
+
+        # Stream the completion, yielding each recommendation as soon as its object closes
+        # The pinned client reports no usage on streamed completions, so use the local count
+        recommendations = []
+        input_tokens = self._count_message_tokens(messages)
+        await self._await_token_budget(input_tokens + self.max_tokens)
+        async with self._get_request_semaphore():
+            response = await openai.ChatCompletion.acreate(
+                model=self.model_name,
+                messages=messages,
+                max_tokens=self.max_tokens,
+                temperature=self.temperature,
+                stream=True
+            )
+
+            async for rec in self._aparse_recommendation_stream(response):
+                recommendations.append(rec)
+                yield rec, input_tokens
+                if len(recommendations) == 5:
+                    break
+
+        self._store_cached_recommendations(cache_key, embedding, recommendations)
+
+    def _start_inflight(self, cache_key):
+        """
+        Register a future that identical concurrent requests can await
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[cache_key] = future
+        return future
+
+    def _finish_inflight(self, cache_key, future, result=None, error=None):
+        """
+        Resolve an in-flight future for any waiting duplicates and release its key
+        """
+        if not future.done():
+            if result is not None:
+                future.set_result(result)
+            else:
+                future.set_exception(error or RuntimeError("In-flight recommendation request was cancelled"))
+                # Mark the exception as retrieved in case no other request was waiting
+                future.exception()
 
+        if self._inflight.get(cache_key) is future:
+            del self._inflight[cache_key]
+
+    def _complete_recommendations(self, user_preferences, recommendations, all_products, input_tokens=0):
+        """
+        Top up LLM recommendations to 5 and build the response payload
+        """
         # Fallback: if less than 5, fill with random products matching preferences
         if len(recommendations) < 5:
             fallback = self._get_fallback_recommendations(user_preferences, recommendations, all_products)
@@ -79,28 +693,240 @@ class LLMService:
 
         return {
             "recommendations": recommendations[:5],
-            "count": len(recommendations[:5])
+            "count": len(recommendations[:5]),
+            # Prompt tokens billed by the API for this request (0 when served from cache)
+            "input_tokens_used": input_tokens
         }
 
+    def _get_prompt_tokens(self, response, messages):
+        """
+        Read the billed prompt token count from a chat completion, estimating it if not reported
+        """
+        usage = response.get('usage') or {}
+        return usage.get('prompt_tokens', self._count_message_tokens(messages))
+
+    def _get_request_semaphore(self):
+        """
+        Lazily create the semaphore bounding concurrent OpenAI requests
+        """
+        if self._request_semaphore is None:
+            self._request_semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+        return self._request_semaphore
+
+    async def _await_token_budget(self, tokens):
+        """
+        Wait until the rolling one-minute token window has room for a request
+        """
+        if not self.tokens_per_minute:
+            return
+
+        while True:
+            now = time.monotonic()
+            while self._token_window and now - self._token_window[0][0] >= 60:
+                self._token_window.popleft()
+
+            used = sum(t for _, t in self._token_window)
+            if not self._token_window or used + tokens <= self.tokens_per_minute:
+                self._token_window.append((now, tokens))
+                return
+
+            await asyncio.sleep(60 - (now - self._token_window[0][0]))
+
+    def _sync_catalog(self, all_products):
+        """
+        Index the catalog and drop cached responses when its content changes
+        """
+        if all_products is self._catalog_ref:
+            return
+
+        catalog_version = hashlib.sha256(
+            json.dumps(all_products, sort_keys=True).encode()
+        ).hexdigest()
+
+        if catalog_version != self._catalog_version:
+            self._invalidate_caches(catalog_version)
+
+        self._catalog_ref = all_products
+        self._catalog_version = catalog_version
+        self._by_id = {p['id']: p for p in all_products}
+        self._categories = np.array([p['category'] for p in all_products], dtype=str)
+        self._brands = np.array([p['brand'] for p in all_products], dtype=str)
+        self._prices = np.array([p['price'] for p in all_products], dtype=float)
+        self._build_inverted_index(all_products)
+
+    def _invalidate_caches(self, catalog_version):
+        """
+        Evict cache entries of a previous catalog version and reload the semantic index
+        """
+        stored_version = _llm_cache.get(CATALOG_VERSION_KEY)
+        if stored_version != catalog_version:
+            if stored_version is not None:
+                _llm_cache.evict(stored_version)
+            _llm_cache.set(CATALOG_VERSION_KEY, catalog_version)
+
+        self._catalog_blocks.clear()
+        self._clear_semantic_cache()
+        for key in _llm_cache.iterkeys():
+            if not (isinstance(key, str) and key.startswith(SEMANTIC_KEY_PREFIX)):
+                continue
+            entry, expire_time = _llm_cache.get(key, expire_time=True)
+            if entry is not None and entry[0] == (catalog_version, self._prompt_version):
+                self._append_semantic_entry(entry[1], entry[2], expire_time or float('inf'))
+
+    def _build_inverted_index(self, all_products):
+        """
+        Map each category, brand and price range to the catalog indices it covers
+        """
+        self._by_category = {}
+        self._by_brand = {}
+        self._by_price_range = {price_range: [] for price_range in self.PRICE_RANGES}
+
+        for i, p in enumerate(all_products):
+            self._by_category.setdefault(p['category'], []).append(i)
+            self._by_brand.setdefault(p['brand'], []).append(i)
+            for price_range in self.PRICE_RANGES:
+                min_price, max_price = self._get_price_range_bounds(price_range)
+                if min_price <= p['price'] <= max_price:
+                    self._by_price_range[price_range].append(i)
+
+    def _get_browsed_products(self, browsing_history):
+        """
+        Resolve browsing history ids to catalog products in a stable order
+        """
+        return [self._by_id[i] for i in sorted(browsing_history) if i in self._by_id]
+
+    def _get_cache_key(self, user_preferences, browsing_history):
+        """
+        Build a deterministic cache key from the normalized request inputs
+        """
+        prefs = {
+            k: sorted(v) if isinstance(v, (list, tuple, set, frozenset)) else v
+            for k, v in user_preferences.items()
+        }
+        payload = {
+            "prefs": sorted(prefs.items()),
+            "hist": sorted(browsing_history),
+            "model": self.model_name,
+            "temp": self.temperature,
+            "catalog": self._catalog_version,
+            "prompt": self._prompt_version
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+    def _get_embedding(self, text):
+        """
+        Embed text for the semantic cache, returning None if the call fails
+        """
+        try:
+            response = openai.Embedding.create(model=self.embedding_model, input=text)
+        except Exception as e:
+            print(f"Error creating embedding: {str(e)}")
+            return None
+
+        return self._normalize_embedding(response)
+
+    async def _aget_embedding(self, text):
+        """
+        Async variant of _get_embedding
+        """
+        try:
+            response = await openai.Embedding.acreate(model=self.embedding_model, input=text)
+        except Exception as e:
+            print(f"Error creating embedding: {str(e)}")
+            return None
+
+        return self._normalize_embedding(response)
+
+    def _normalize_embedding(self, response):
+        """
+        Extract the embedding from an API response as a unit vector
+        """
+        vector = np.asarray(response['data'][0]['embedding'], dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def _lookup_semantic_cache(self, cache_key, embedding, user_preferences, browsing_history):
+        """
+        Return recommendations from the most similar prior request above the threshold,
+        keeping only items that satisfy this request's preferences and browsing history.
+        A hit needs at least semantic_min_matches surviving items; survivors are
+        promoted into the exact cache under cache_key
+        """
+        if embedding is None:
+            return None
+
+        allowed_ids = None
+        for recommendations in _semantic_index.search(embedding, self.semantic_threshold):
+            if allowed_ids is None:
+                allowed_ids = {
+                    p['id'] for p in self._filter_products_by_preferences(user_preferences, self._catalog_ref)
+                    if p['id'] not in browsing_history
+                }
+
+            matching = [r for r in recommendations if r['product']['id'] in allowed_ids]
+            if len(matching) >= self.semantic_min_matches:
+                self._set_cached(cache_key, matching)
+                return matching
+
+        return None
+
+    def _store_cached_recommendations(self, cache_key, embedding, recommendations):
+        """
+        Cache parsed recommendations in the exact and semantic caches
+        """
+        # Only cache usable responses so a bad completion can be retried
+        if recommendations:
+            self._set_cached(cache_key, list(recommendations))
+            self._store_semantic_cache(cache_key, embedding, recommendations)
+
+    def _set_cached(self, key, value):
+        """
+        Write a cache entry with the configured TTL, tagged with the catalog version
+        """
+        _llm_cache.set(key, value, expire=self.cache_ttl, tag=self._catalog_version)
+
+    def _store_semantic_cache(self, cache_key, embedding, recommendations):
+        """
+        Add an embedding and its recommendations to the semantic cache
+        """
+        if embedding is None or _semantic_index.max_entries <= 0:
+            return
+
+        self._set_cached(
+            SEMANTIC_KEY_PREFIX + cache_key,
+            ((self._catalog_version, self._prompt_version), embedding, list(recommendations))
+        )
+        self._append_semantic_entry(embedding, recommendations, time.time() + self.cache_ttl)
+
+    def _append_semantic_entry(self, embedding, recommendations, expires_at):
+        """
+        Add an embedding row and its recommendations to the in-memory semantic index,
+        expiring together with its disk entry
+        """
+        _semantic_index.add(embedding, recommendations, expires_at)
+
+    def _clear_semantic_cache(self):
+        """
+        Drop all entries from the in-memory semantic index
+        """
+        _semantic_index.clear()
+
     def _generate_local_recommendations(self, user_preferences, browsing_history, all_products):
         """
         Generate recommendations using local simulation (no API required)
         """
         # Get browsed products details
-        browsed_products = [p for p in all_products if p['id'] in browsing_history]
+        browsed_products = self._get_browsed_products(browsing_history)
 
         # Filter products based on user preferences
         filtered = self._filter_products_by_preferences(user_preferences, all_products)
 
-        # Remove already browsed products
-        filtered = [p for p in filtered if p['id'] not in browsing_history]
+        # Randomly select up to 5 products, skipping already browsed ones
+        recommended = self._reservoir_sample((p for p in filtered if p['id'] not in browsing_history), 5)
 
         # Fallback if less than 5
-        if len(filtered) < 5:
-            filtered = [p for p in all_products if p['id'] not in browsing_history]
-
-        # Randomly select up to 5 products
-        recommended = random.sample(filtered, min(5, len(filtered)))
+        if len(recommended) < 5:
+            recommended = self._reservoir_sample((p for p in all_products if p['id'] not in browsing_history), 5)
 
         # Build recommendations with explanations
         recommendations = [
@@ -113,91 +939,274 @@ class LLMService:
 
         return {
             "recommendations": recommendations,
-            "count": len(recommendations)
+            "count": len(recommendations),
+            "input_tokens_used": 0
         }
 
+    def _route_locally(self, user_preferences, browsing_history, all_products):
+        """
+        Answer without the LLM when the preferences leave at most local_routing_threshold
+        unbrowsed products; returns None when the LLM should rank the candidates
+        """
+        filtered = self._filter_products_by_preferences(user_preferences, all_products)
+        candidates = [p for p in filtered if p['id'] not in browsing_history]
+        if not candidates or len(candidates) > self.local_routing_threshold:
+            return None
+
+        browsed_products = self._get_browsed_products(browsing_history)
+        recommendations = [
+            {
+                "product": p,
+                "explanation": self._generate_local_explanation(p, user_preferences, browsed_products),
+                "confidence_score": random.randint(6, 10)
+            } for p in candidates[:5]
+        ]
+
+        return {
+            "recommendations": recommendations,
+            "count": len(recommendations),
+            "input_tokens_used": 0,
+            "routed_locally": True
+        }
+
+    def _reservoir_sample(self, products, k):
+        """
+        Uniformly sample up to k items from an iterable in a single pass without materializing it
+        """
+        reservoir = []
+        for i, p in enumerate(products):
+            if i < k:
+                reservoir.append(p)
+            else:
+                j = random.randint(0, i)
+                if j < k:
+                    reservoir[j] = p
+
+        random.shuffle(reservoir)
+        return reservoir
+
     def _create_recommendation_prompt(self, user_preferences, browsed_products, all_products):
         """
-        Create a strong prompt to enforce preferences, JSON output, and diversity
+        Create the dynamic user prompt; the rules live in SYSTEM_PREFIX
         """
-        prompt = "You are an expert eCommerce recommendation assistant.\n"
-        prompt += "Given the user's preferences and browsing history, recommend **exactly 5 products** from the catalog.\n"
-        prompt += "Strictly follow these rules:\n"
-        prompt += "- Only recommend products matching the user's selected categories, brands, and price range.\n"
-        prompt += "- Include a brief explanation for each recommendation.\n"
-        prompt += "- Return output as a JSON array with keys: product_id, explanation, score (1-10 confidence).\n"
-        prompt += "- Ensure diversity in recommendations.\n\n"
+        self._sync_catalog(all_products)
 
-        # User preferences
-        prompt += "User Preferences:\n"
-        for k, v in user_preferences.items():
-            prompt += f"- {k}: {v}\n"
+        return "".join([
+            # User preferences and browsing history
+            self._format_user_context(user_preferences, browsed_products),
+            # Provide a compact catalog of candidates matching the preferences
+            self._catalog_block(user_preferences)
+        ])
 
-        # Browsing history
-        if browsed_products:
-            prompt += "\nBrowsing History:\n"
-            for p in browsed_products:
-                prompt += f"- {p['name']} (Category: {p['category']}, Price: ${p['price']}, Brand: {p['brand']})\n"
+    def _catalog_block(self, user_preferences):
+        """
+        Format the candidate catalog block for a preference set, memoized per catalog version
+        """
+        key = (self._freeze_preferences(user_preferences), self._catalog_version)
+        block = self._catalog_blocks.get(key)
+        if block is None:
+            if len(self._catalog_blocks) >= 64:
+                self._catalog_blocks.clear()
+            block = self._catalog_blocks[key] = self._format_catalog_block(user_preferences)
+        return block
+
+    def _format_catalog_block(self, user_preferences):
+        """
+        Pack the products matching the preferences into a CSV block within the catalog token budget
+        """
+        candidates = self._filter_products_by_preferences(user_preferences, self._catalog_ref) or self._catalog_ref
+
+        lines = ["", "Catalog (CSV):", "id,name,cat,brand,price"]
+        used_tokens = self._count_tokens("\n".join(lines) + "\n")
+
+        # Pack product rows greedily until the catalog token budget is reached
+        for p in candidates:
+            line = f"{p['id']},{p['name']},{p['category']},{p['brand']},{p['price']}"
+            line_tokens = self._count_tokens(line + "\n")
+            if used_tokens + line_tokens > self.catalog_token_budget:
+                break
+            lines.append(line)
+            used_tokens += line_tokens
+
+        return "\n".join(lines) + "\n"
+
+    def _load_encoding(self):
+        """
+        Load the tiktoken encoding for the configured model, or None if unavailable
+        """
+        try:
+            try:
+                return tiktoken.encoding_for_model(self.model_name)
+            except KeyError:
+                return tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            print(f"Error loading tokenizer, estimating token counts: {str(e)}")
+            return None
+
+    def _count_tokens(self, text):
+        """
+        Count the tokens in text, estimating 4 characters per token without a tokenizer
+        """
+        count = self._token_counts.get(text)
+        if count is None:
+            encoding = self._encoding
+            count = len(text) // 4 + 1 if encoding is None else len(encoding.encode(text))
+            if len(self._token_counts) >= 1024:
+                self._token_counts.clear()
+            self._token_counts[text] = count
+        return count
+
+    def _count_message_tokens(self, messages):
+        """
+        Count the input tokens of chat messages, including the static system prefix
+        """
+        total = 0
+        for message in messages:
+            content = message["content"]
+            if isinstance(content, list):
+                content = "".join(block["text"] for block in content)
+            # Each message carries a few tokens of role/formatting overhead
+            total += self._count_tokens(content) + 4
+        return total
 
-        # Provide catalog summary
-        prompt += "\nCatalog contains the following products (showing only names and categories for brevity):\n"
-        for p in all_products[:50]:  # avoid token overload
-            prompt += f"- {p['name']} (Category: {p['category']}, Price: ${p['price']}, Brand: {p['brand']})\n"
+    def _freeze_preferences(self, user_preferences):
+        """
+        Convert preferences to a hashable tuple, keeping key order for prompt formatting
+        """
+        return tuple(
+            (k, tuple(sorted(v)) if isinstance(v, (set, frozenset)) else tuple(v) if isinstance(v, list) else v)
+            for k, v in user_preferences.items()
+        )
 
-        prompt += "\nRespond ONLY with the JSON array, no extra text."
+    def _build_messages(self, prompt):
+        """
+        Build chat messages with the static system prefix ahead of the user prompt
+        """
+        system_content = self.SYSTEM_PREFIX
+        if self.prompt_cache_control and not openai.api_base.startswith("https://api.openai.com"):
+            # Explicit cache breakpoint for Anthropic-compatible routers
+            system_content = [{
+                "type": "text",
+                "text": self.SYSTEM_PREFIX,
+                "cache_control": {"type": "ephemeral"}
+            }]
 
-        return prompt
+        return [
+            {"role": "system", "content": system_content},
+            {"role": "user", "content": prompt}
+        ]
+
+    def _format_user_context(self, user_preferences, browsed_products):
+        """
+        Format the user-specific part of the prompt (preferences and browsing history)
+        """
+        parts = ["User Preferences:\n"]
+        parts.extend(f"- {k}: {v}\n" for k, v in user_preferences.items())
+
+        if browsed_products:
+            parts.append("\nBrowsing History:\n")
+            parts.extend(
+                f"- {p['name']} (Category: {p['category']}, Price: ${p['price']}, Brand: {p['brand']})\n"
+                for p in browsed_products
+            )
+
+        return "".join(parts)
 
     def _parse_recommendation_response(self, llm_response, all_products):
         """
         Parse LLM response and enrich with full product info
         """
         try:
-            # Extract JSON array from response
+            # Decode the first JSON array of objects in the response, skipping
+            # surrounding prose and bracketed text such as "Top [5] picks"
+            rec_list = None
             start_idx = llm_response.find('[')
-            end_idx = llm_response.rfind(']') + 1
-            if start_idx == -1 or end_idx == 0:
-                return []
+            while start_idx != -1:
+                try:
+                    candidate, _ = _json_decoder.raw_decode(llm_response, start_idx)
+                except ValueError:
+                    candidate = None
+                if isinstance(candidate, list) and any(isinstance(rec, dict) for rec in candidate):
+                    rec_list = candidate
+                    break
+                start_idx = llm_response.find('[', start_idx + 1)
 
-            rec_list = json.loads(llm_response[start_idx:end_idx])
+            if rec_list is None:
+                return []
 
             enriched_recs = []
             for rec in rec_list:
-                product_id = rec.get('product_id')
-                product = next((p for p in all_products if p['id'] == product_id), None)
-                if product:
-                    enriched_recs.append({
-                        "product": product,
-                        "explanation": rec.get('explanation', ''),
-                        "confidence_score": rec.get('score', 5)
-                    })
+                enriched = self._enrich_recommendation(rec)
+                if enriched:
+                    enriched_recs.append(enriched)
 
             return enriched_recs
         except Exception as e:
             print(f"Error parsing LLM response: {str(e)}")
             return []
 
+    async def _aparse_recommendation_stream(self, response):
+        """
+        Parse a streamed LLM response, yielding each enriched recommendation once its JSON object is complete
+        """
+        parser = _JSONObjectStreamParser()
+        async for chunk in response:
+            content = chunk.choices[0].delta.get('content')
+            if not content:
+                continue
+
+            for rec in parser.feed(content):
+                enriched = self._enrich_recommendation(rec)
+                if enriched:
+                    yield enriched
+
+    def _enrich_recommendation(self, rec):
+        """
+        Attach full product info to a single parsed recommendation, or return None for unknown products
+        """
+        if not isinstance(rec, dict):
+            return None
+
+        product_id = rec.get('product_id')
+        if not isinstance(product_id, str):
+            return None
+
+        product = self._by_id.get(product_id)
+        if not product:
+            return None
+
+        return {
+            "product": product,
+            "explanation": rec.get('explanation', ''),
+            "confidence_score": rec.get('score', 5)
+        }
+
     def _filter_products_by_preferences(self, preferences, all_products):
         """
-        Filter products based on user preferences
+        Filter products based on user preferences using vectorized masks over cached catalog columns
         """
-        filtered = all_products.copy()
+        self._sync_catalog(all_products)
+        categories = frozenset(preferences.get('categories') or ())
+        brands = frozenset(preferences.get('brands') or ())
+        idx = np.arange(len(self._prices))
+        mask = np.ones(len(idx), dtype=bool)
 
         # Apply category filter
-        if preferences.get('categories'):
-            filtered = [p for p in filtered if p['category'] in preferences['categories']]
+        if categories:
+            mask &= np.isin(self._categories, list(categories))
 
         # Apply brand filter
-        if preferences.get('brands'):
-            filtered = [p for p in filtered if p['brand'] in preferences['brands']]
+        if brands:
+            mask &= np.isin(self._brands, list(brands))
 
         # Apply price range filter
         price_range = preferences.get('priceRange', 'all')
         if price_range != 'all':
             min_price, max_price = self._get_price_range_bounds(price_range)
-            filtered = [p for p in filtered if min_price <= p['price'] <= max_price]
+            mask &= (self._prices >= min_price) & (self._prices <= max_price)
 
-        return filtered
+        # Gather from the original list so callers get the same product dicts
+        return [all_products[i] for i in idx[mask]]
 
     def _get_price_range_bounds(self, price_range):
         """
@@ -235,24 +1244,51 @@ class LLMService:
         """
         If LLM returns <5, fill with random products matching preferences
         """
-        existing_ids = [r['product']['id'] for r in existing_recs]
+        self._sync_catalog(all_products)
+        existing_ids = {r['product']['id'] for r in existing_recs}
 
-        # Filter catalog by preferences
-        filtered = self._filter_products_by_preferences(preferences, all_products)
-        filtered = [p for p in filtered if p['id'] not in existing_ids]
+        # Look up catalog positions matching the preferences in the inverted index
+        candidates = [
+            i for i in self._get_preference_candidates(preferences)
+            if all_products[i]['id'] not in existing_ids
+        ]
+        needed = max(5 - len(existing_recs), 0)
 
         # Randomly select remaining recommendations
         fallback = []
-        random.shuffle(filtered)
-        for p in filtered[:5 - len(existing_recs)]:
+        for i in random.sample(candidates, min(needed, len(candidates))):
             fallback.append({
-                "product": p,
+                "product": all_products[i],
                 "explanation": "Additional recommendation based on your preferences.",
                 "confidence_score": 5
             })
 
         return fallback
 
+    def _get_preference_candidates(self, preferences):
+        """
+        Return sorted catalog indices matching the preferences using the inverted index
+        """
+        categories = frozenset(preferences.get('categories') or ())
+        brands = frozenset(preferences.get('brands') or ())
+        candidates = None
+
+        if categories:
+            candidates = set().union(*(self._by_category.get(c, ()) for c in categories))
+
+        if brands:
+            brand_matches = set().union(*(self._by_brand.get(b, ()) for b in brands))
+            candidates = brand_matches if candidates is None else candidates & brand_matches
+
+        price_range = preferences.get('priceRange', 'all')
+        if price_range in self._by_price_range:
+            price_matches = set(self._by_price_range[price_range])
+            candidates = price_matches if candidates is None else candidates & price_matches
+
+        if candidates is None:
+            return range(len(self._catalog_ref or ()))
+        return sorted(candidates)
+
     def set_mode(self, use_openai=True):
         """
         Switch between OpenAI and local mode
@@ -51,3 +51,60 @@ export const getRecommendations = async (userPreferences, browsingHistory) => {
     throw error;
   }
 };
+
+/**
+ * Stream product recommendations, invoking a callback as each one arrives
+ * @param {Object} userPreferences - { priceRange, categories, brands, minRating }
+ * @param {Array} browsingHistory - array of product IDs
+ * @param {Function} onRecommendation - called with each recommendation object
+ */
+export const streamRecommendations = async (userPreferences, browsingHistory, onRecommendation) => {
+  try {
+    const payload = {
+      preferences: userPreferences,
+      browsing_history: browsingHistory
+    };
+
+    const response = await fetch(`${API_BASE_URL}/recommendations/stream`, {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json"
+      },
+      body: JSON.stringify(payload)
+    });
+
+    if (!response.ok) {
+      const text = await response.text();
+      throw new Error(`Failed to stream recommendations: ${response.status}, ${text}`);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    const recommendations = [];
+    let buffer = "";
+
+    const emitLine = (line) => {
+      if (line.trim()) {
+        const rec = JSON.parse(line);
+        recommendations.push(rec);
+        onRecommendation(rec);
+      }
+    };
+
+    while (true) {
+      const { done, value } = await reader.read();
+      if (done) break;
+
+      buffer += decoder.decode(value, { stream: true });
+      const lines = buffer.split("\n");
+      buffer = lines.pop();
+      lines.forEach(emitLine);
+    }
+    emitLine(buffer);
+
+    return recommendations;
+  } catch (error) {
+    console.error("streamRecommendations error:", error);
+    throw error;
+  }
+};
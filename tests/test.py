@@ -184,6 +184,48 @@ def test_prompt_engineering_adaptation():
     except Exception as e:
         return False, str(e)
 
+def test_recommendations_stream_endpoint():
+    """Test that the streaming endpoint returns one recommendation object per line"""
+    try:
+        products = requests.get(f"{API_BASE_URL}/products").json()
+        product_ids = {product["id"] for product in products}
+        
+        payload = {
+            "preferences": {
+                "priceRange": "all",
+                "categories": ["Electronics"],
+                "brands": []
+            },
+            "browsing_history": ["prod002", "prod007"]
+        }
+        
+        response = requests.post(f"{API_BASE_URL}/recommendations/stream", json=payload, stream=True)
+        
+        # Check response status
+        if response.status_code != 200:
+            return False, f"Expected status code 200, got {response.status_code}"
+        
+        # Each non-empty line must be a recommendation for a catalog product
+        line_count = 0
+        for line in response.iter_lines(decode_unicode=True):
+            if not line:
+                continue
+            rec = json.loads(line)
+            if "product" not in rec:
+                return False, "Streamed recommendation missing 'product' field"
+            if "explanation" not in rec:
+                return False, "Streamed recommendation missing 'explanation' field"
+            if rec["product"].get("id") not in product_ids or "name" not in rec["product"]:
+                return False, f"Streamed recommendation has an invalid product: {rec['product'].get('id')}"
+            line_count += 1
+        
+        if line_count == 0:
+            return False, "No recommendations streamed"
+        
+        return True, None
+    except Exception as e:
+        return False, str(e)
+
 def main():
     print_header("AI-Powered Product Recommendation Engine - Self-Evaluation Test")
     
@@ -213,6 +255,10 @@ def main():
     prompt_adapt_result, prompt_adapt_message = test_prompt_engineering_adaptation()
     print_result("Prompt Engineering Adaptation", prompt_adapt_result, prompt_adapt_message)
     
+    # Test streaming recommendations endpoint
+    stream_result, stream_message = test_recommendations_stream_endpoint()
+    print_result("Streaming Recommendations Endpoint", stream_result, stream_message)
+    
     # Summary
     print("\n" + "-"*80)
     tests_passed = sum([
@@ -220,9 +266,10 @@ def main():
         products_result, 
         rec_structure_result, 
         rec_quality_result,
-        prompt_adapt_result
+        prompt_adapt_result,
+        stream_result
     ])
-    total_tests = 5
+    total_tests = 6
     
     print(f"Tests passed: {tests_passed}/{total_tests} ({tests_passed/total_tests*100:.0f}%)")
     